@@ -1,32 +1,120 @@
 """Flask application for VisionClaim Motor Claim Estimator."""
+import copy
+import hashlib
 import os
-import uuid
-from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, url_for, flash, session
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, abort, g, render_template, request, jsonify, send_from_directory, redirect, url_for, flash, session
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+import orjson
 from dotenv import load_dotenv
-
-from utils.preprocessing import allowed_file, preprocess_image, ensure_upload_dir, get_image_metadata
+from cachetools import LRUCache
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from celery import Celery
+from celery.signals import worker_process_init
+from celery.result import AsyncResult
+from kombu.serialization import register as register_serializer
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import FileTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
+
+from utils.preprocessing import ALLOWED_EXTENSIONS, split_ext, preprocess_image, ensure_upload_dir, MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE
 from utils.detection import detect_damage, init_client
 from utils.severity import assess_severity
-from utils.cost_estimator import estimate_costs, load_cost_data
+from utils.cost_estimator import estimate_costs, get_exchange_rates, start_rate_refresher, exchange_rates_status
 from utils.report_generator import generate_report
-from database.db import create_user, verify_user, get_db, save_scan, get_user_scans, get_scan, save_claim, get_scan_by_report_id
+from database.db import create_user, verify_user, find_user_by_id, get_db, save_scan, get_user_scans, get_scan, save_claim, get_scan_by_report_id, save_scans_bulk
 from pymongo import errors as mongo_errors
+from bson.objectid import ObjectId
 
 load_dotenv()
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson for request parsing and jsonify responses."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get('sort_keys'):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__, static_folder='static', template_folder='templates')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
+app.json = ORJSONProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', 'visionclaim-dev-key-2024')
 
+DASHBOARD_PAGE_SIZE = 20  # scan cards per dashboard page
+MAX_BATCH_FILES = 10      # images per /api/analyze/batch request
+# Global body cap: a full batch plus multipart overhead. Single uploads are held to
+# MAX_UPLOAD_SIZE per file by the streaming parser's validator.
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE * MAX_BATCH_FILES + 1024 * 1024
+UPLOAD_DIR = os.fspath(ensure_upload_dir())
+# Internal Nginx location for uploads, e.g. /_protected_uploads (unset: Flask serves them)
+X_ACCEL_UPLOADS = os.environ.get('X_ACCEL_UPLOADS', '').rstrip('/')
+
 # Initialize OpenAI client
 init_client(os.environ.get('OPENAI_API_KEY'))
 
+# Background workers for the analysis pipeline
+# Run with: celery -A app.celery worker --concurrency=4
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+celery = Celery('visionclaim', broker=REDIS_URL, backend=REDIS_URL)
+
+# Reports travel to and from the workers as JSON; serialize them with orjson
+register_serializer('orjson', orjson.dumps, orjson.loads,
+                    content_type='application/x-orjson', content_encoding='binary')
+celery.conf.update(
+    task_serializer='orjson',
+    result_serializer='orjson',
+    accept_content=['orjson', 'json'],
+)
+
+
+# Keep exchange rates fresh in the background (no-op unless EXCHANGE_RATES_URL is set)
+start_rate_refresher()
+
+
+@worker_process_init.connect
+def _start_worker_rate_refresher(**kwargs):
+    """Prefork Celery children run estimate_costs; give each its own refresher after fork."""
+    start_rate_refresher()
+
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', 'memory://'),
+)
+
+_db_warmed = False
+
+
+@app.before_request
+def warm_db_pool():
+    """Create the Mongo client (and its pool) once per worker, after fork."""
+    global _db_warmed
+    if _db_warmed:
+        return
+    _db_warmed = True
+    try:
+        get_db()
+    except Exception as e:
+        print(f"Failed to warm database pool: {e}")
+
 
 @app.context_processor
 def inject_currency():
     """Injects currency information into all templates."""
-    cost_data = load_cost_data()
-    exchange_rates = cost_data.get('exchange_rates', {})
+    exchange_rates = get_exchange_rates()
     selected_currency = session.get('currency', 'INR')
     
     currency_info = exchange_rates.get(selected_currency, exchange_rates.get('INR'))
@@ -38,17 +126,43 @@ def inject_currency():
     }
 
 
+def _login(user):
+    """Store only the user id and first name in the signed session cookie."""
+    session['uid'] = user['id']
+    session['fn'] = user['first_name']
+
+
+def current_user():
+    """Return the logged-in user's profile, loaded at most once per request."""
+    if 'user' not in g:
+        uid = session.get('uid')
+        g.user = find_user_by_id(uid) if uid else None
+    return g.user
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    """Bodies over MAX_CONTENT_LENGTH, including chunked ones caught mid-read."""
+    return jsonify({'error': 'Upload too large.'}), 413
+
+
 @app.route('/api/set_currency', methods=['POST'])
 def set_currency():
     """Sets the user's preferred currency."""
     currency_code = request.json.get('currency')
-    cost_data = load_cost_data()
-    if currency_code in cost_data.get('exchange_rates', {}):
+    if currency_code in get_exchange_rates():
         session['currency'] = currency_code
         return jsonify({'success': True})
     return jsonify({'success': False, 'error': 'Invalid currency'}), 400
 
 
+@app.route('/healthz')
+def healthz():
+    """Liveness probe reporting exchange rate freshness."""
+    rates = exchange_rates_status()
+    return jsonify({'status': 'degraded' if rates['stale'] else 'ok', 'exchange_rates': rates})
+
+
 @app.route('/')
 def index():
     """Landing page."""
@@ -56,9 +170,10 @@ def index():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('10 per minute', methods=['POST'])
 def login():
     """Login page — authenticates against MongoDB."""
-    if session.get('user'):
+    if session.get('uid'):
         return redirect(url_for('estimate'))
 
     if request.method == 'POST':
@@ -71,7 +186,7 @@ def login():
             try:
                 user = verify_user(email, password)
                 if user:
-                    session['user'] = user
+                    _login(user)
                     flash(f'Welcome back, {user["first_name"]}! 👋', 'success')
                     return redirect(url_for('dashboard'))
                 else:
@@ -85,7 +200,7 @@ def login():
 @app.route('/signup', methods=['GET', 'POST'])
 def signup():
     """Sign-up page — creates a new user in MongoDB."""
-    if session.get('user'):
+    if session.get('uid'):
         return redirect(url_for('estimate'))
 
     if request.method == 'POST':
@@ -104,7 +219,7 @@ def signup():
         else:
             try:
                 user = create_user(first_name, last_name, email, password)
-                session['user'] = user
+                _login(user)
                 flash(f'Account created! Welcome to VisionClaim, {first_name} 🎉', 'success')
                 return redirect(url_for('dashboard'))
             except ValueError as e:
@@ -132,35 +247,36 @@ def estimate():
 @app.route('/dashboard')
 def dashboard():
     """User scan history dashboard."""
-    if not session.get('user'):
+    if not session.get('uid'):
         flash('Please log in to view your dashboard.', 'info')
         return redirect(url_for('login'))
     
-    user_id = session['user']['id']
-    scans = get_user_scans(user_id)
-    
-    # Process scans for display
-    for scan in scans:
-        scan['id_str'] = str(scan['_id'])
-        # Extract meaningful info for cards
-        report = scan.get('data', {})
-        v_info = report.get('vehicle_info', {})
-        scan['vehicle_name'] = f"{v_info.get('color', 'Vehicle').title()} {v_info.get('type', 'Scan').title()}"
-        scan['total_cost'] = report.get('cost_estimate', {}).get('total', 0)
-        scan['currency_symbol'] = report.get('cost_estimate', {}).get('symbol', '₹')
-        scan['date_formatted'] = scan['created_at'].strftime('%b %d, %Y')
-        scan['fault_count'] = len(report.get('damage_assessment', {}).get('damages', []))
+    user_id = session['uid']
+    try:
+        page = int(request.args.get('page', 1))
+    except ValueError:
+        page = 1
+    before_id = request.args.get('before')
+    if before_id and not ObjectId.is_valid(before_id):
+        before_id = None
+
+    # Fetch one extra card to know whether there is another page
+    scans = get_user_scans(user_id, page=page, page_size=DASHBOARD_PAGE_SIZE, before_id=before_id,
+                           limit=DASHBOARD_PAGE_SIZE + 1)
+    has_more = len(scans) > DASHBOARD_PAGE_SIZE
+    scans = scans[:DASHBOARD_PAGE_SIZE]
+    next_before = scans[-1]['id_str'] if has_more else None
 
-    return render_template('dashboard.html', scans=scans)
+    return render_template('dashboard.html', scans=scans, next_before=next_before)
 
 
 @app.route('/analysis/<scan_id>')
 def detailed_analysis(scan_id):
     """Detailed AI Damage Analysis view."""
-    if not session.get('user'):
+    if not session.get('uid'):
         return redirect(url_for('login'))
         
-    scan = get_scan(scan_id, user_id=session['user']['id'])
+    scan = get_scan(scan_id, user_id=session['uid'])
     if not scan:
         flash('Scan not found.', 'error')
         return redirect(url_for('dashboard'))
@@ -174,10 +290,10 @@ def detailed_analysis(scan_id):
 @app.route('/payouts/<scan_id>')
 def payouts(scan_id):
     """Settlement and Payouts view."""
-    if not session.get('user'):
+    if not session.get('uid'):
         return redirect(url_for('login'))
         
-    scan = get_scan(scan_id, user_id=session['user']['id'])
+    scan = get_scan(scan_id, user_id=session['uid'])
     if not scan:
         flash('Scan not found.', 'error')
         return redirect(url_for('dashboard'))
@@ -187,106 +303,278 @@ def payouts(scan_id):
     return render_template('payouts.html', scan=scan, report=report)
 
 
+# Runs whole per-image pipelines for batch uploads; OpenCV and file I/O release the GIL
+_analysis_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='analyze')
+
+
+# Detection results keyed by upload content hash, per worker process
+_detection_cache: LRUCache = LRUCache(maxsize=128)
+_detection_cache_lock = threading.Lock()
+
+
+def _file_digest(path):
+    """Fast content hash of a file, used as a cache key."""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).digest()
+
+
+def _analyze_image(filepath, filename, currency='INR', on_stage=None):
+    """Run the damage analysis pipeline on a saved upload and return the report."""
+    stage = on_stage or (lambda name: None)
+
+    # Identical uploads (retries, re-runs in another currency) reuse the earlier detection
+    digest = _file_digest(filepath)
+    with _detection_cache_lock:
+        cached = _detection_cache.get(digest)
+
+    # Preprocess; metadata comes from the same decode and the image is reused for detection.
+    # This runs on cache hits too so every upload is resized on disk and described accurately.
+    stage('preprocessing')
+    img, metadata = preprocess_image(filepath, with_metadata=True)
+
+    if cached:
+        detection_result = copy.deepcopy(cached)
+    else:
+        # Detect damage
+        stage('detecting')
+        detection_result = detect_damage(filepath, img)
+        with _detection_cache_lock:
+            _detection_cache[digest] = copy.deepcopy(detection_result)
+
+    if not detection_result.get('vehicle_detected', False):
+        return {
+            'error': 'No vehicle detected in the image. Please upload a clear photo of a damaged vehicle.'
+        }
+
+    # Assess severity
+    stage('assessing')
+    severity_assessment = assess_severity(detection_result.get('damages', []))
+
+    # Estimate costs
+    stage('estimating')
+    cost_estimate = estimate_costs(
+        detection_result.get('damages', []),
+        severity_assessment,
+        target_currency=currency
+    )
+
+    # Generate report
+    report = generate_report(
+        detection_result,
+        severity_assessment,
+        cost_estimate,
+        image_filename=filename
+    )
+
+    report['image_url'] = f'/uploads/{filename}'
+    report['image_metadata'] = metadata
+    return report
+
+
+@celery.task(bind=True)
+def run_analysis(self, filepath, filename, user_id=None, currency='INR'):
+    """Analyze a single upload and persist it for logged-in users."""
+    report = _analyze_image(
+        filepath, filename, currency,
+        on_stage=lambda name: self.update_state(state='PROGRESS', meta={'stage': name})
+    )
+
+    # Persist to database if logged in
+    if user_id and not report.get('error'):
+        try:
+            scan_db_id = save_scan(user_id, report)
+            report['scan_db_id'] = scan_db_id
+        except Exception as db_err:
+            print(f"Failed to save scan: {db_err}")
+
+    return report
+
+
+@celery.task(bind=True)
+def run_batch_analysis(self, uploads, user_id=None, currency='INR'):
+    """Analyze several uploads concurrently and persist the successful ones in one bulk write."""
+    self.update_state(state='PROGRESS', meta={'stage': 'analyzing', 'total': len(uploads)})
+    futures = [
+        _analysis_pool.submit(_analyze_image, filepath, filename, currency)
+        for filepath, filename in uploads
+    ]
+
+    reports = []
+    for future, (_, filename) in zip(futures, uploads):
+        try:
+            reports.append(future.result())
+        except Exception as e:
+            reports.append({'error': f'Analysis failed: {str(e)}', 'image_file': filename})
+
+    # Persist to database if logged in
+    saved = [report for report in reports if not report.get('error')]
+    if user_id and saved:
+        try:
+            for report, scan_db_id in zip(saved, save_scans_bulk(user_id, saved)):
+                if scan_db_id:
+                    report['scan_db_id'] = scan_db_id
+        except Exception as db_err:
+            print(f"Failed to save scans: {db_err}")
+
+    return {'reports': reports}
+
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
-    """API endpoint for image analysis."""
-    if 'image' not in request.files:
+    """API endpoint for image analysis — queues the pipeline and returns a task id."""
+    # Stream the multipart body straight to disk instead of going through request.files
+    name = secrets.token_hex(8)
+    part_path = f"{UPLOAD_DIR}{os.sep}{name}.part"
+    target = FileTarget(part_path, validator=MaxSizeValidator(MAX_UPLOAD_SIZE))
+
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('image', target)
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            parser.data_received(chunk)
+    except (ValidationError, RequestEntityTooLarge):
+        _discard(part_path)
+        return jsonify({'error': 'File too large. Maximum size is 16MB.'}), 413
+    except Exception:
+        _discard(part_path)
+        return jsonify({'error': 'Malformed upload'}), 400
+
+    if target.multipart_filename is None:
+        _discard(part_path)
         return jsonify({'error': 'No image file provided'}), 400
 
-    file = request.files['image']
-    if file.filename == '':
+    if target.multipart_filename == '':
+        _discard(part_path)
         return jsonify({'error': 'No file selected'}), 400
 
-    if not allowed_file(file.filename):
+    ext = split_ext(target.multipart_filename)
+    if ext not in ALLOWED_EXTENSIONS:
+        _discard(part_path)
         return jsonify({'error': 'Invalid file type. Allowed: png, jpg, jpeg, webp, bmp'}), 400
 
     try:
-        # Save uploaded file
-        upload_dir = ensure_upload_dir()
-        ext = file.filename.rsplit('.', 1)[1].lower()
-        filename = f"{uuid.uuid4().hex}.{ext}"
-        filepath = os.path.join(upload_dir, filename)
-        file.save(filepath)
+        # Give the uploaded file its final name
+        filename = f"{name}.{ext}"
+        filepath = f"{UPLOAD_DIR}{os.sep}{filename}"
+        os.replace(part_path, filepath)
+
+        task = run_analysis.delay(
+            filepath,
+            filename,
+            user_id=session.get('uid'),
+            currency=session.get('currency', 'INR')
+        )
+        return jsonify({'task_id': task.id}), 202
 
-        # Preprocess
-        preprocess_image(filepath)
+    except Exception as e:
+        return jsonify({'error': f'Analysis failed: {str(e)}'}), 500
 
-        # Get image metadata
-        metadata = get_image_metadata(filepath)
 
-        # Detect damage
-        detection_result = detect_damage(filepath)
+def _stream_size(stream):
+    """Size of a spooled upload stream, leaving it rewound for saving."""
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    return size
 
-        if not detection_result.get('vehicle_detected', False):
-            return jsonify({
-                'error': 'No vehicle detected in the image. Please upload a clear photo of a damaged vehicle.'
-            }), 400
 
-        # Assess severity
-        severity_assessment = assess_severity(detection_result.get('damages', []))
+@app.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """API endpoint for analyzing several images in one request."""
+    files = [f for f in request.files.getlist('images') if f.filename]
+    if not files:
+        return jsonify({'error': 'No image files provided'}), 400
 
-        # Estimate costs
-        cost_estimate = estimate_costs(
-            detection_result.get('damages', []),
-            severity_assessment,
-            target_currency=session.get('currency', 'INR')
-        )
-
-        # Generate report
-        report = generate_report(
-            detection_result,
-            severity_assessment,
-            cost_estimate,
-            image_filename=filename
-        )
+    if len(files) > MAX_BATCH_FILES:
+        return jsonify({'error': f'Too many files. Maximum is {MAX_BATCH_FILES} per batch.'}), 400
 
-        report['image_url'] = f'/uploads/{filename}'
-        report['image_metadata'] = metadata
+    exts = [split_ext(f.filename) for f in files]
+    if not all(ext in ALLOWED_EXTENSIONS for ext in exts):
+        return jsonify({'error': 'Invalid file type. Allowed: png, jpg, jpeg, webp, bmp'}), 400
 
-        # Persist to database if logged in
-        if session.get('user'):
-            try:
-                scan_db_id = save_scan(session['user']['id'], report)
-                report['scan_db_id'] = scan_db_id
-            except Exception as db_err:
-                print(f"Failed to save scan: {db_err}")
+    # Same per-file limit as /api/analyze; MAX_CONTENT_LENGTH only bounds the whole batch
+    if any(_stream_size(f.stream) > MAX_UPLOAD_SIZE for f in files):
+        return jsonify({'error': 'File too large. Maximum size is 16MB.'}), 413
 
-        return jsonify(report)
+    try:
+        uploads = []
+        for file, ext in zip(files, exts):
+            filename = f"{secrets.token_hex(8)}.{ext}"
+            filepath = f"{UPLOAD_DIR}{os.sep}{filename}"
+            file.save(filepath, buffer_size=UPLOAD_CHUNK_SIZE)
+            uploads.append((filepath, filename))
+
+        task = run_batch_analysis.delay(
+            uploads,
+            user_id=session.get('uid'),
+            currency=session.get('currency', 'INR')
+        )
+        return jsonify({'task_id': task.id}), 202
 
     except Exception as e:
         return jsonify({'error': f'Analysis failed: {str(e)}'}), 500
 
 
+def _discard(path):
+    """Remove a partially written upload, ignoring missing files."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@app.route('/api/analyze/<task_id>')
+def analyze_status(task_id):
+    """Poll the state of a queued analysis task."""
+    task = AsyncResult(task_id, app=celery)
+
+    if task.state == 'SUCCESS':
+        report = task.result or {}
+        if report.get('error'):
+            return jsonify({'state': task.state, 'error': report['error']}), 400
+        return jsonify({'state': task.state, 'result': report})
+
+    if task.state == 'FAILURE':
+        return jsonify({'state': task.state, 'error': f'Analysis failed: {str(task.info)}'}), 500
+
+    info = task.info if isinstance(task.info, dict) else {}
+    return jsonify({'state': task.state, 'info': info}), 202
+
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    """Serve uploaded files."""
-    upload_dir = ensure_upload_dir()
-    return send_from_directory(upload_dir, filename)
+    """Serve uploaded files, handing the transfer to Nginx when X_ACCEL_UPLOADS is set."""
+    if X_ACCEL_UPLOADS:
+        # Nginx: location /_protected_uploads/ { internal; alias /var/app/uploads/; sendfile on; tcp_nopush on; }
+        internal_path = safe_join(X_ACCEL_UPLOADS, filename)
+        if internal_path is None:
+            abort(404)
+        return Response(headers={'X-Accel-Redirect': internal_path, 'Content-Type': ''})
+    return send_from_directory(UPLOAD_DIR, filename)
 
 
 @app.route('/claim/<report_id>')
 def claim_page(report_id):
     """Render the insurance claim page."""
-    if 'user' not in session:
+    if 'uid' not in session:
         flash('Please log in to file a claim.', 'info')
         return redirect(url_for('login', next=f'/claim/{report_id}'))
     
-    scan_doc = get_scan_by_report_id(report_id, user_id=session['user']['id'])
+    scan_doc = get_scan_by_report_id(report_id, user_id=session['uid'])
     if not scan_doc:
         flash('Report not found or access denied.', 'error')
         return redirect(url_for('dashboard'))
     
-    return render_template('claim.html', scan=scan_doc['data'])
+    return render_template('claim.html', scan=scan_doc['data'], user=current_user())
 
 
 @app.route('/api/submit_claim', methods=['POST'])
 def submit_claim():
     """Handle insurance claim submission."""
-    if 'user' not in session:
+    if 'uid' not in session:
         return jsonify({'success': False, 'error': 'Authentication required'}), 401
     
     data = request.json
-    data['user_id'] = session['user']['id']
+    data['user_id'] = session['uid']
     
     try:
         claim_id = save_claim(data)
@@ -296,5 +584,4 @@ def submit_claim():
 
 
 if __name__ == '__main__':
-    ensure_upload_dir()
     app.run(debug=True, host='0.0.0.0', port=5000)
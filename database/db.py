@@ -1,10 +1,18 @@
 """MongoDB database connection and user management utilities."""
 import os
+import threading
+import time
 import uuid
 import bcrypt
+from argon2 import PasswordHasher
+from cachetools import TTLCache
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
 from datetime import datetime, timezone
-from pymongo import MongoClient, errors
+from pymongo import IndexModel, InsertOne, MongoClient, errors
 from pymongo.collection import Collection
+from pymongo.write_concern import WriteConcern
+from bson.objectid import ObjectId
+_UTC = timezone.utc
 _client: MongoClient | None = None
 _db = None
 def get_db():
@@ -13,25 +21,85 @@ def get_db():
     if _db is None:
         mongo_uri = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
         db_name   = os.environ.get('MONGO_DB',  'visionclaim')
-        _client   = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+        _client   = MongoClient(
+            mongo_uri,
+            serverSelectionTimeoutMS=5000,
+            maxPoolSize=200,
+            minPoolSize=10,
+            maxIdleTimeMS=300_000,
+            retryWrites=True,
+            compressors='zstd,snappy,zlib',
+            w='majority',
+            connect=False,  # fork-safe under gunicorn --preload
+        )
         _db       = _client[db_name]
-        # Ensure unique email index
-        _db.users.create_index('email', unique=True)
+    _ensure_indexes(_db)
     return _db
 
 
+_indexes_ready = False
+
+
+def _ensure_indexes(db) -> None:
+    """
+    Create the indexes our queries rely on. Runs once per process; if the server
+    can't be reached it is retried on the next get_db() call.
+    """
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    try:
+        # Unique email for signup, compound indexes for the newest-first listings
+        db.users.create_indexes([IndexModel('email', unique=True)])
+        db.scans.create_indexes([
+            IndexModel([('user_id', 1), ('_id', -1)]),
+            IndexModel('data.report_id'),
+        ])
+        db.claims.create_indexes([IndexModel([('user_id', 1), ('submitted_at', -1)])])
+    except errors.OperationFailure as e:
+        # The server rejected the spec (permissions, conflicting index); retrying won't help
+        print(f"Failed to create indexes: {e}")
+    except errors.PyMongoError as e:
+        print(f"Failed to create indexes, will retry: {e}")
+        return
+    _indexes_ready = True
+
+
 def get_users() -> Collection:
     return get_db().users
 
 
 # ── Password helpers ──────────────────────────────────────────────────────────
 
-def hash_password(plain: str) -> bytes:
-    return bcrypt.hashpw(plain.encode('utf-8'), bcrypt.gensalt())
+# Argon2id parameters tuned for our CPU budget (~2 passes over 64 MiB)
+_ph = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2)
+
+
+def hash_password(plain: str) -> str:
+    return _ph.hash(plain)
+
+
+def is_legacy_hash(hashed: str | bytes) -> bool:
+    """True for bcrypt hashes stored before the switch to argon2id."""
+    if isinstance(hashed, bytes):
+        hashed = hashed.decode('utf-8')
+    return hashed.startswith(('$2a$', '$2b$', '$2y$'))
+
 
+def check_password(plain: str, hashed: str | bytes) -> bool:
+    if is_legacy_hash(hashed):
+        if isinstance(hashed, str):
+            hashed = hashed.encode('utf-8')
+        return bcrypt.checkpw(plain.encode('utf-8'), hashed)
+    try:
+        return _ph.verify(hashed, plain)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
 
-def check_password(plain: str, hashed: bytes) -> bool:
-    return bcrypt.checkpw(plain.encode('utf-8'), hashed)
+
+def needs_rehash(hashed: str | bytes) -> bool:
+    """True if the stored hash is bcrypt or uses outdated argon2 parameters."""
+    return is_legacy_hash(hashed) or _ph.check_needs_rehash(hashed)
 
 
 # ── User CRUD ─────────────────────────────────────────────────────────────────
@@ -44,25 +112,60 @@ def create_user(first_name: str, last_name: str, email: str, password: str) -> d
     email = email.lower().strip()
     users = get_users()
 
-    if users.find_one({'email': email}):
-        raise ValueError('An account with this email already exists.')
-
     doc = {
         'first_name':  first_name.strip(),
         'last_name':   last_name.strip(),
         'email':       email,
         'password':    hash_password(password),
-        'created_at':  datetime.now(timezone.utc),
+        'created_at':  datetime.now(_UTC),
         'last_login':  None,
     }
-    result = users.insert_one(doc)
+    # The unique email index enforces uniqueness atomically
+    try:
+        result = users.insert_one(doc)
+    except errors.DuplicateKeyError:
+        raise ValueError('An account with this email already exists.')
+    finally:
+        with _user_cache_lock:
+            _user_cache.pop(email, None)
     doc['_id'] = result.inserted_id
     return _safe(doc)
 
 
+# Short-lived cache of email -> user document (or None for unknown emails) so
+# repeated login attempts for the same address stay out of Mongo
+_user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=5)
+_user_cache_lock = threading.Lock()
+_MISSING = object()
+
+
 def find_user_by_email(email: str) -> dict | None:
     """Return a full user document (including hashed password) or None."""
-    return get_users().find_one({'email': email.lower().strip()})
+    email = email.lower().strip()
+    with _user_cache_lock:
+        user = _user_cache.get(email, _MISSING)
+    if user is _MISSING:
+        user = get_users().find_one({'email': email})
+        with _user_cache_lock:
+            _user_cache[email] = user
+    return user
+
+
+_user_id_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+
+def find_user_by_id(user_id: str) -> dict | None:
+    """Return a safe user dict (no password) for a session user id, cached briefly."""
+    if not ObjectId.is_valid(user_id):
+        return None
+    with _user_cache_lock:
+        user = _user_id_cache.get(user_id, _MISSING)
+    if user is _MISSING:
+        doc = get_users().find_one({'_id': ObjectId(user_id)}, {'password': 0})
+        user = _safe(doc) if doc else None
+        with _user_cache_lock:
+            _user_id_cache[user_id] = user
+    return user
 
 
 def verify_user(email: str, password: str) -> dict | None:
@@ -76,20 +179,22 @@ def verify_user(email: str, password: str) -> dict | None:
     if not check_password(password, user['password']):
         return None
 
-    # Update last_login
-    get_users().update_one(
+    # Update last_login, upgrading legacy bcrypt hashes while we have the plaintext.
+    # Unacknowledged write: login should not wait on it, and a lost update is harmless.
+    update = {'last_login': datetime.now(_UTC)}
+    if needs_rehash(user['password']):
+        update['password'] = hash_password(password)
+    get_users().with_options(write_concern=WriteConcern(w=0)).update_one(
         {'_id': user['_id']},
-        {'$set': {'last_login': datetime.now(timezone.utc)}}
+        {'$set': update}
     )
     return _safe(user)
 
 
 # ── Scan Persistence ──────────────────────────────────────────────────────────
 
-def save_scan(user_id: str, scan_data: dict) -> str:
-    """Save a scan report for a user."""
-    db = get_db()
-    
+def _scan_doc(user_id: str, scan_data: dict) -> dict:
+    """Build the scan document stored for a report."""
     # Use report_id from AI if available, else generate unique one
     scan_id = scan_data.get('report_id') or f"SCAN-{uuid.uuid4().hex[:12].upper()}"
     
@@ -101,22 +206,93 @@ def save_scan(user_id: str, scan_data: dict) -> str:
         'user_id': user_id,
         'scan_id': scan_id,
         'data': scan_data,
-        'created_at': datetime.now(timezone.utc),
+        'created_at': datetime.now(_UTC),
         'status': 'Under Review' if overall_severity == 'severe' else 'Completed'
     }
-    result = db.scans.insert_one(scan_doc)
+    return scan_doc
+
+
+def save_scan(user_id: str, scan_data: dict) -> str:
+    """Save a scan report for a user."""
+    db = get_db()
+    result = db.scans.insert_one(_scan_doc(user_id, scan_data))
     return str(result.inserted_id)
 
 
-def get_user_scans(user_id: str):
-    """Retrieve all scans for a specific user, newest first."""
+def save_scans_bulk(user_id: str, scans: list[dict]) -> list[str | None]:
+    """
+    Save several scan reports for a user in one unordered bulk write.
+    Returns one id per scan, in order, with None for any insert the server rejected.
+    """
+    if not scans:
+        return []
+    db = get_db()
+    # Assign _ids up front so every id is known whichever inserts succeed
+    docs = [{'_id': ObjectId(), **_scan_doc(user_id, scan_data)} for scan_data in scans]
+    failed = set()
+    try:
+        db.scans.bulk_write([InsertOne(doc) for doc in docs], ordered=False)
+    except errors.BulkWriteError as e:
+        # Unordered: the other inserts still went through
+        failed = {err['index'] for err in e.details.get('writeErrors', [])}
+        print(f"Failed to save {len(failed)} of {len(docs)} scans: {e}")
+    return [None if i in failed else str(doc['_id']) for i, doc in enumerate(docs)]
+
+
+def _title(expr: str) -> dict:
+    """Aggregation expression approximating str.title() for a single-word field."""
+    return {'$concat': [
+        {'$toUpper': {'$substrCP': [expr, 0, 1]}},
+        {'$toLower': {'$substrCP': [expr, 1, {'$strLenCP': expr}]}},
+    ]}
+
+
+# Summary fields the dashboard cards render, computed server-side
+SCAN_CARD_PROJECTION = {
+    'id_str': {'$toString': '$_id'},
+    'scan_id': 1,
+    'status': 1,
+    'created_at': 1,
+    'data.image_url': 1,
+    'vehicle_name': {'$concat': [
+        _title({'$ifNull': ['$data.vehicle_info.color', 'Vehicle']}),
+        ' ',
+        _title({'$ifNull': ['$data.vehicle_info.type', 'Scan']}),
+    ]},
+    'total_cost': {'$ifNull': ['$data.cost_estimate.total', 0]},
+    'currency_symbol': {'$ifNull': ['$data.cost_estimate.symbol', '₹']},
+    'fault_count': {'$size': {'$ifNull': ['$data.damage_assessment.damages', []]}},
+}
+
+
+def get_user_scans(user_id: str, page: int = 1, page_size: int = 20, before_id: str | None = None,
+                   limit: int | None = None):
+    """
+    Retrieve one page of dashboard card summaries for a user, newest first.
+    Pass before_id (the last _id of the previous page) for keyset pagination;
+    otherwise page/page_size fall back to skip/limit. limit caps the rows returned
+    (defaults to page_size) without moving the page boundaries.
+    """
     db = get_db()
-    return list(db.scans.find({'user_id': user_id}).sort('created_at', -1))
+    match = {'user_id': user_id}
+    pipeline = []
+    if before_id:
+        match['_id'] = {'$lt': ObjectId(before_id)}
+    else:
+        pipeline.append({'$skip': (max(page, 1) - 1) * page_size})
+    return list(db.scans.aggregate([
+        {'$match': match},
+        {'$sort': {'_id': -1}},
+        *pipeline,
+        {'$limit': limit or page_size},
+        {'$project': SCAN_CARD_PROJECTION},
+    ]))
 
 
 def get_scan(scan_id: str, user_id: str = None):
     """Retrieve a specific scan by its database ID."""
-    from bson.objectid import ObjectId
+    if not ObjectId.is_valid(scan_id):
+        return None
     db = get_db()
     query = {'_id': ObjectId(scan_id)}
     if user_id:
@@ -136,7 +312,7 @@ def get_scan_by_report_id(report_id: str, user_id: str = None):
 def save_claim(claim_data: dict) -> str:
     """Save an official insurance claim."""
     db = get_db()
-    claim_id = f"CLM-{datetime.now().strftime('%y%m%d%H%M%S')}"
+    claim_id = f"CLM-{time.strftime('%y%m%d%H%M%S')}"
     claim_doc = {
         'claim_id': claim_id,
         'report_id': claim_data.get('report_id'),
@@ -150,7 +326,7 @@ def save_claim(claim_data: dict) -> str:
             'description': claim_data.get('incident_description')
         },
         'status': 'Submitted',
-        'submitted_at': datetime.now(timezone.utc)
+        'submitted_at': datetime.now(_UTC)
     }
     result = db.claims.insert_one(claim_doc)
     return claim_id
@@ -0,0 +1,20 @@
+"""Gunicorn settings for production: gunicorn app:app (picked up automatically)."""
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# One process per core; threads cover requests blocked on Mongo, Redis or disk
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Import the app once before forking; the Mongo client is created lazily per worker
+preload_app = True
+timeout = 60
+keepalive = 5
+
+
+def post_fork(server, worker):
+    # Background threads started during preload stay in the master; restart them per worker
+    from utils.cost_estimator import start_rate_refresher
+    start_rate_refresher()
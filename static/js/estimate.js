@@ -147,22 +147,45 @@ async function runFileAnalysis(file) {
         fd.append('image', file);
 
         const response = await fetch('/api/analyze', { method: 'POST', body: fd });
-        const data = await response.json().catch(() => ({}));
+        const queued = await response.json().catch(() => ({}));
+
+        if (!response.ok) {
+            await simulateLoadingSteps();
+            showError(queued?.error || 'Analysis failed. Please try another image.');
+            return;
+        }
+
+        const { ok, data } = await pollAnalysis(queued.task_id);
 
         await simulateLoadingSteps();
 
-        if (!response.ok) {
+        if (!ok) {
             showError(data?.error || 'Analysis failed. Please try another image.');
             return;
         }
 
-        displayReport(data);
+        displayReport(data.result);
     } catch (err) {
         await simulateLoadingSteps();
         showError('Network error while analyzing. Please try again.');
     }
 }
 
+/** Poll the analysis task until the worker finishes it or the attempts run out */
+async function pollAnalysis(taskId, intervalMs = 1000, maxAttempts = 120) {
+    for (let attempt = 0; attempt < maxAttempts; attempt++) {
+        // eslint-disable-next-line no-await-in-loop
+        const response = await fetch(`/api/analyze/${taskId}`);
+        // eslint-disable-next-line no-await-in-loop
+        const data = await response.json().catch(() => ({}));
+        if (response.status !== 202) return { ok: response.ok, data };
+        // eslint-disable-next-line no-await-in-loop
+        await new Promise(r => setTimeout(r, intervalMs));
+    }
+    // Unknown task ids and an idle queue both stay PENDING forever
+    return { ok: false, data: { error: 'Analysis is taking too long. Please try again later.' } };
+}
+
 function showError(message) {
     const loading = document.getElementById('loadingState');
     const content = document.getElementById('resultsContent');
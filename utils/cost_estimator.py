@@ -1,13 +1,215 @@
 """Cost estimation module for vehicle damage repairs."""
+import functools
 import json
+import math
 import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import orjson
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to plain Python
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+COST_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'cost_data.json')
+# Set COST_DATA_RELOAD=1 in development to pick up edits to cost_data.json without a restart
+COST_DATA_RELOAD = os.environ.get('COST_DATA_RELOAD', '').lower() in ('1', 'true', 'yes')
+
+
+@functools.lru_cache(maxsize=1)
+def _read_cost_data(mtime=None):
+    """Parse the JSON database; cached so the file is read once per process (or per mtime)."""
+    with open(COST_DATA_PATH, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def _cost_data_mtime():
+    return os.path.getmtime(COST_DATA_PATH) if COST_DATA_RELOAD else None
 
 
 def load_cost_data():
-    """Load cost data from the JSON database."""
-    db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'cost_data.json')
-    with open(db_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    """Load cost data from the JSON database. The returned dict is shared — do not mutate it."""
+    return _read_cost_data(_cost_data_mtime())
+
+
+# Damage types that always need a replacement part
+_REPLACE_DT = frozenset({'shatter', 'structural'})
+# Glass/lamp damage on these parts needs no repaint
+_NO_PAINT_DT = frozenset({'shatter', 'crack'})
+_NO_PAINT_PART = frozenset({'headlight', 'taillight', 'windshield', 'side_mirror'})
+
+# Costs used for parts missing from the database:
+# (repair_min, repair_max, replace_min, replace_max, repair_hours, replace_hours)
+DEFAULT_PART_COSTS = (4500, 12000, 15000, 45000, 2, 3)
+
+
+@functools.lru_cache(maxsize=1)
+def _build_cost_tables(mtime=None):
+    """Flatten the nested parts table into one tuple per part (see DEFAULT_PART_COSTS)."""
+    cost_data = _read_cost_data(mtime)
+    # Keys are interned so the interned labels from detection match them on identity
+    parts_flat = {
+        sys.intern(key): (
+            info['name'],
+            info['repair_cost']['min'], info['repair_cost']['max'],
+            info['replacement_cost']['min'], info['replacement_cost']['max'],
+            info['labor_hours']['repair'], info['labor_hours']['replacement'],
+        )
+        for key, info in cost_data['parts'].items()
+    }
+    return parts_flat, {sys.intern(k): v for k, v in cost_data['severity_multipliers'].items()}
+
+
+def load_cost_tables():
+    """Return (parts_flat, severity_multipliers) built from the cached cost data."""
+    return _build_cost_tables(_cost_data_mtime())
+
+
+# ── Exchange rates ────────────────────────────────────────────────────────────
+# Rates are seeded from cost_data.json and, when EXCHANGE_RATES_URL is set,
+# refreshed in the background. The feed returns {"rates": {"USD": 0.012, ...}}
+# relative to INR. Readers only ever see the last good snapshot.
+EXCHANGE_RATES_URL = os.environ.get('EXCHANGE_RATES_URL', '')
+EXCHANGE_RATES_REFRESH = int(os.environ.get('EXCHANGE_RATES_REFRESH', 900))  # seconds
+
+_rates_lock = threading.Lock()
+_rates = None
+_rates_mtime = None
+_rates_updated_at = None
+_rates_etag = None
+_refresher_pid = None
+
+
+def get_exchange_rates():
+    """
+    Return the current exchange rate table (no I/O once seeded).
+    With COST_DATA_RELOAD, edits to cost_data.json reseed the table; live feed
+    values are reapplied on the next refresh.
+    """
+    global _rates, _rates_mtime
+    mtime = _cost_data_mtime()
+    if _rates is None or mtime != _rates_mtime:
+        with _rates_lock:
+            if _rates is None or mtime != _rates_mtime:
+                _rates = load_cost_data().get('exchange_rates', {})
+                _rates_mtime = mtime
+    return _rates
+
+
+def _live_rate(live, code, fallback):
+    """Rate for code from the feed, or fallback if it is missing or not a positive number."""
+    try:
+        rate = float(live.get(code, fallback))
+    except (TypeError, ValueError):
+        return fallback
+    return rate if math.isfinite(rate) and rate > 0 else fallback
+
+
+def refresh_exchange_rates(timeout=2):
+    """Fetch live rates once; keep serving the previous table on any failure."""
+    global _rates, _rates_updated_at, _rates_etag
+    if not EXCHANGE_RATES_URL:
+        return False
+
+    req = urllib.request.Request(EXCHANGE_RATES_URL)
+    if _rates_etag:
+        req.add_header('If-None-Match', _rates_etag)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            payload = json.load(resp)
+            etag = resp.headers.get('ETag')
+        live = payload.get('rates') if isinstance(payload, dict) else None
+        if not isinstance(live, dict):
+            raise ValueError("response has no 'rates' object")
+        current = get_exchange_rates()
+        # Only update currencies we know how to display; bad entries keep their previous rate
+        updated = {
+            code: {**info, 'rate': _live_rate(live, code, info['rate'])}
+            for code, info in current.items()
+        }
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            _rates_updated_at = time.time()
+            return True
+        print(f"Exchange rate refresh failed: {e}")
+        return False
+    except Exception as e:
+        print(f"Exchange rate refresh failed: {e}")
+        return False
+
+    with _rates_lock:
+        _rates = updated
+        _rates_etag = etag
+        _rates_updated_at = time.time()
+    return True
+
+
+def start_rate_refresher():
+    """
+    Start the background refresh thread once per process (no-op without a feed URL).
+    Threads do not survive fork, so a forked worker calling this starts its own.
+    """
+    global _refresher_pid
+    if not EXCHANGE_RATES_URL or _refresher_pid == os.getpid():
+        return
+
+    def _loop():
+        while True:
+            try:
+                refresh_exchange_rates()
+            except Exception as e:
+                # Never let one bad refresh end the thread
+                print(f"Exchange rate refresh failed: {e}")
+            time.sleep(EXCHANGE_RATES_REFRESH)
+
+    threading.Thread(target=_loop, name='exchange-rates', daemon=True).start()
+    _refresher_pid = os.getpid()
+
+
+def exchange_rates_status():
+    """Describe where the rate table came from and how fresh it is."""
+    if _rates_updated_at is None:
+        return {'source': 'static', 'updated_at': None, 'age_seconds': None, 'stale': bool(EXCHANGE_RATES_URL)}
+    age = time.time() - _rates_updated_at
+    return {
+        'source': 'live',
+        'updated_at': _rates_updated_at,
+        'age_seconds': round(age, 1),
+        'stale': age > 2 * EXCHANGE_RATES_REFRESH
+    }
+
+
+@njit(cache=True)
+def _aggregate_costs(cost_min, cost_max, multipliers, hours, labor_rate, paint_min, paint_max, paint_mask):
+    """Per-damage costs and their totals in base currency; paint only where paint_mask is set."""
+    n = cost_min.shape[0]
+    part_costs = np.empty(n)
+    labor_costs = np.empty(n)
+    panel_paint_costs = np.empty(n)
+    subtotals = np.empty(n)
+    total_parts = 0.0
+    total_labor = 0.0
+    total_paint = 0.0
+    for i in range(n):
+        part = cost_min[i] + (cost_max[i] - cost_min[i]) * multipliers[i]
+        labor = hours[i] * labor_rate
+        panel_paint = paint_min + (paint_max - paint_min) * multipliers[i]
+        paint = panel_paint if paint_mask[i] else 0.0
+        part_costs[i] = part
+        labor_costs[i] = labor
+        panel_paint_costs[i] = panel_paint
+        subtotals[i] = part + labor + paint
+        total_parts += part
+        total_labor += labor
+        total_paint += paint
+    return part_costs, labor_costs, panel_paint_costs, subtotals, total_parts, total_labor, total_paint
 
 
 def estimate_costs(damages, severity_assessment, target_currency=None):
@@ -16,13 +218,12 @@ def estimate_costs(damages, severity_assessment, target_currency=None):
     Returns detailed cost breakdown with totals.
     """
     cost_data = load_cost_data()
-    parts_db = cost_data['parts']
+    parts_flat, severity_multipliers = load_cost_tables()
     labor_rate = cost_data['labor_rate_per_hour']
     paint_cost = cost_data['paint_cost_per_panel']
-    severity_multipliers = cost_data['severity_multipliers']
     
     # Currency configuration
-    exchange_rates = cost_data.get('exchange_rates', {})
+    exchange_rates = get_exchange_rates()
     if target_currency and target_currency in exchange_rates:
         rate = exchange_rates[target_currency]['rate']
         symbol = exchange_rates[target_currency]['symbol']
@@ -32,67 +233,78 @@ def estimate_costs(damages, severity_assessment, target_currency=None):
         symbol = exchange_rates.get('INR', {}).get('symbol', '₹')
         currency_code = 'INR'
 
-    line_items = []
-    total_parts_cost = 0
-    total_labor_cost = 0
-    total_paint_cost = 0
+    # Gather per-damage inputs; the cost arithmetic below runs over whole arrays
+    n = len(damages)
+    cost_min = np.empty(n)
+    cost_max = np.empty(n)
+    multipliers = np.empty(n)
+    hours = np.empty(n)
+    paint_mask = np.empty(n, dtype=bool)
+    details = []
 
-    for damage in damages:
+    for i, damage in enumerate(damages):
         part_key = damage.get('part', '')
         severity = damage.get('severity', 'minor')
         damage_type = damage.get('damage_type', 'scratch')
 
-        part_info = parts_db.get(part_key, None)
-        if not part_info:
+        part = parts_flat.get(part_key)
+        if part:
+            part_name, repair_min, repair_max, replace_min, replace_max, repair_hours, replace_hours = part
+        else:
             # Default costs for unknown parts
-            part_info = {
-                'name': part_key.replace('_', ' ').title(),
-                'repair_cost': {'min': 4500, 'max': 12000},
-                'replacement_cost': {'min': 15000, 'max': 45000},
-                'labor_hours': {'repair': 2, 'replacement': 3}
-            }
+            part_name = part_key.replace('_', ' ').title()
+            repair_min, repair_max, replace_min, replace_max, repair_hours, replace_hours = DEFAULT_PART_COSTS
 
-        multiplier = severity_multipliers.get(severity, 0.5)
+        multipliers[i] = severity_multipliers.get(severity, 0.5)
 
         # Determine if repair or replacement
-        needs_replacement = severity == 'severe' or damage_type in ['shatter', 'structural']
+        needs_replacement = severity == 'severe' or damage_type in _REPLACE_DT
 
         if needs_replacement:
-            cost_range = part_info['replacement_cost']
-            labor_hours = part_info['labor_hours']['replacement']
+            cost_min[i], cost_max[i] = replace_min, replace_max
+            labor_hours = replace_hours
             action = 'Replace'
         else:
-            cost_range = part_info['repair_cost']
-            labor_hours = part_info['labor_hours']['repair']
+            cost_min[i], cost_max[i] = repair_min, repair_max
+            labor_hours = repair_hours
             action = 'Repair'
-
-        # Calculate costs in base currency (INR)
-        part_cost_base = cost_range['min'] + (cost_range['max'] - cost_range['min']) * multiplier
-        labor_cost_base = labor_hours * labor_rate
-        panel_paint_cost_base = paint_cost['min'] + (paint_cost['max'] - paint_cost['min']) * multiplier
+        hours[i] = labor_hours
 
         # Only add paint for visible damage
-        needs_paint = damage_type not in ['shatter', 'crack'] or part_key not in ['headlight', 'taillight', 'windshield', 'side_mirror']
+        paint_mask[i] = damage_type not in _NO_PAINT_DT or part_key not in _NO_PAINT_PART
+
+        details.append((part_name, part_key, action, damage_type, severity, labor_hours))
 
-        # Convert to target currency
-        item = {
-            'part_name': part_info['name'],
+    # Calculate costs in base currency (INR)
+    part_costs, labor_costs, panel_paint_costs, subtotals, *totals = _aggregate_costs(
+        cost_min, cost_max, multipliers, hours, float(labor_rate),
+        float(paint_cost['min']), float(paint_cost['max']), paint_mask
+    )
+    # Plain floats so round() below behaves identically with or without numba
+    total_parts_cost, total_labor_cost, total_paint_cost = (float(t) for t in totals)
+
+    # Convert to target currency
+    converted = zip(
+        (part_costs * rate).tolist(),
+        (labor_costs * rate).tolist(),
+        (panel_paint_costs * rate).tolist(),
+        (subtotals * rate).tolist(),
+        paint_mask.tolist(),
+    )
+    line_items = []
+    for (part_name, part_key, action, damage_type, severity, labor_hours), (part_cost, labor_cost, panel_paint_cost, subtotal, needs_paint) in zip(details, converted):
+        line_items.append({
+            'part_name': part_name,
             'part_key': part_key,
             'action': action,
             'damage_type': damage_type.replace('_', ' ').title(),
             'severity': severity,
-            'part_cost': round(part_cost_base * rate, 2),
-            'labor_cost': round(labor_cost_base * rate, 2),
+            'part_cost': round(part_cost, 2),
+            'labor_cost': round(labor_cost, 2),
             'labor_hours': labor_hours,
-            'paint_cost': round(panel_paint_cost_base * rate, 2) if needs_paint else 0,
-            'subtotal': round((part_cost_base + labor_cost_base + (panel_paint_cost_base if needs_paint else 0)) * rate, 2)
-        }
-
-        line_items.append(item)
-        total_parts_cost += part_cost_base
-        total_labor_cost += labor_cost_base
-        if needs_paint:
-            total_paint_cost += panel_paint_cost_base
+            'paint_cost': round(panel_paint_cost, 2) if needs_paint else 0,
+            'subtotal': round(subtotal, 2)
+        })
 
     subtotal_base = total_parts_cost + total_labor_cost + total_paint_cost
     tax_rate = 0.18  # GST in India
@@ -119,51 +331,63 @@ def estimate_costs(damages, severity_assessment, target_currency=None):
     }
 
 
+# Recommendation per overall severity; anything else (including 'severe') needs review
+_RECOMMENDATIONS = {
+    'minor': {
+        'status': 'PRE-APPROVED',
+        'status_color': '#22c55e',
+        'message': 'This claim of {symbol}{total_cost:,.2f} is pre-approved for immediate processing.',
+        'next_steps': (
+            'Choose a certified repair shop from our network',
+            'Schedule your repair appointment',
+            'Repairs will begin upon vehicle drop-off'
+        )
+    },
+    'moderate': {
+        'status': 'PRE-APPROVED',
+        'status_color': '#22c55e',
+        'message': 'This claim of {symbol}{total_cost:,.2f} is pre-approved. A brief review may be conducted.',
+        'next_steps': (
+            'Select a certified repair facility',
+            'An adjuster may contact you within 24 hours',
+            'Repairs can proceed after brief verification'
+        )
+    },
+    'severe': {
+        'status': 'REVIEW REQUIRED',
+        'status_color': '#f59e0b',
+        'message': 'This claim of {symbol}{total_cost:,.2f} requires adjuster review due to severity.',
+        'next_steps': (
+            'An adjuster will be assigned within 2 hours',
+            'In-person inspection may be required',
+            'Estimated review completion: 24-48 hours'
+        )
+    }
+}
+
+
 def get_recommendation(severity_assessment, total_cost, symbol='₹'):
     """Generate a recommendation based on severity and cost."""
     overall = severity_assessment.get('overall', 'minor')
-
-    if overall == 'minor':
-        return {
-            'status': 'PRE-APPROVED',
-            'status_color': '#22c55e',
-            'message': f'This claim of {symbol}{total_cost:,.2f} is pre-approved for immediate processing.',
-            'next_steps': [
-                'Choose a certified repair shop from our network',
-                'Schedule your repair appointment',
-                'Repairs will begin upon vehicle drop-off'
-            ]
-        }
-    elif overall == 'moderate':
-        return {
-            'status': 'PRE-APPROVED',
-            'status_color': '#22c55e',
-            'message': f'This claim of {symbol}{total_cost:,.2f} is pre-approved. A brief review may be conducted.',
-            'next_steps': [
-                'Select a certified repair facility',
-                'An adjuster may contact you within 24 hours',
-                'Repairs can proceed after brief verification'
-            ]
-        }
-    else:
-        return {
-            'status': 'REVIEW REQUIRED',
-            'status_color': '#f59e0b',
-            'message': f'This claim of {symbol}{total_cost:,.2f} requires adjuster review due to severity.',
-            'next_steps': [
-                'An adjuster will be assigned within 2 hours',
-                'In-person inspection may be required',
-                'Estimated review completion: 24-48 hours'
-            ]
-        }
+    rec = _RECOMMENDATIONS.get(overall, _RECOMMENDATIONS['severe'])
+    return {
+        'status': rec['status'],
+        'status_color': rec['status_color'],
+        'message': rec['message'].format(symbol=symbol, total_cost=total_cost),
+        'next_steps': list(rec['next_steps'])
+    }
 
 
 def estimate_repair_time(line_items):
     """Estimate total repair time in business days."""
-    total_hours = sum(item['labor_hours'] for item in line_items)
+    total_hours = 0
+    has_replacement = False
+    for item in line_items:
+        total_hours += item['labor_hours']
+        has_replacement = has_replacement or item['action'] == 'Replace'
     # Assume 6 productive hours per day
     days = max(1, round(total_hours / 6))
     # Add buffer for parts ordering
-    if any(item['action'] == 'Replace' for item in line_items):
+    if has_replacement:
         days += 2
     return days
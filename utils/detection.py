@@ -1,94 +1,141 @@
 """Refined local damage detection module using OpenCV with spatial heuristics."""
-import json
 import os
+import sys
+import threading
 import cv2
 import numpy as np
 
+from utils.preprocessing import MAX_DIM
+
+# Detection already runs on several threads; keep OpenCV from oversubscribing cores
+cv2.setNumThreads(min(2, os.cpu_count() or 1))
+
+_CLOSE_KERNEL = np.ones((3, 3), np.uint8)
+_scratch = threading.local()
+
+
+def _scratch_buffers(shape):
+    """Per-thread gray/blur/edge/close buffers, reused while the frame size stays the same."""
+    cached = getattr(_scratch, 'buffers', None)
+    if cached is None or cached[0] != shape:
+        cached = (shape, tuple(np.empty(shape, np.uint8) for _ in range(4)))
+        _scratch.buffers = cached
+    return cached[1]
+
+
+def classify_regions(rects, areas, width, height):
+    """
+    Map candidate regions to damage entries.
+    rects is an (N, 4) array of x, y, w, h bounding boxes and areas the matching contour areas;
+    every rule is evaluated over all regions at once.
+    """
+    x, y, w, h = rects.T
+    aspect_ratio = np.divide(w, h, out=np.zeros_like(w), where=h > 0)
+
+    # 1. Precise Part Identification via Spatial Mapping (Heuristics)
+    # Normalizing coordinates (0.0 to 1.0)
+    nx = (x + w / 2) / width
+    ny = (y + h / 2) / height
+
+    # Corners (headlights/taillights) take precedence over the positional bands
+    corner = ((nx < 0.15) | (nx > 0.85)) & (ny > 0.6) & (ny < 0.8)
+    parts = np.select(
+        [corner & (nx < 0.5), corner,
+         (ny > 0.75) & (nx < 0.5), ny > 0.75,
+         (ny < 0.35) & (nx < 0.7), ny < 0.35,
+         (nx < 0.2) | (nx > 0.8),
+         (ny > 0.4) & (ny < 0.7)],
+        ['headlight', 'taillight',
+         'front_bumper', 'rear_bumper',
+         'hood', 'roof',
+         'fender',
+         'door'],
+        default='body_panel'
+    )
+
+    # 2. Damage Type Classification via Shape Analysis
+    # Long, thin contours are likely scratches. Large, rounder ones are dents.
+    scratch = (aspect_ratio > 4) | (aspect_ratio < 0.25)
+    damage_types = np.select(
+        [scratch, areas > 10000, areas > 5000],
+        ['scratch', 'dent', 'deformation'],
+        default='paint_damage'
+    )
+
+    # 3. Severity Calculation
+    dent = ~scratch & (areas > 10000)
+    severities = np.select(
+        [areas > 35000, (areas > 15000) | (dent & (areas > 8000))],
+        ['severe', 'moderate'],
+        default='minor'
+    )
+
+    # tolist() hands back fresh str objects; intern the labels so later dict lookups
+    # (severity table, cost tables — whose keys are interned too) hit on identity
+    return [
+        {
+            "part": sys.intern(part),
+            "damage_type": sys.intern(damage_type),
+            "severity": sys.intern(severity),
+            "confidence": round(0.75 + (min(area, 20000) / 200000), 2),
+            "description": f"Local analysis detected {damage_type} on the {part.replace('_', ' ')} (Size: {int(area)}px)."
+        }
+        for part, damage_type, severity, area in zip(parts.tolist(), damage_types.tolist(), severities.tolist(), areas.tolist())
+    ]
+
+
 def init_client(api_key=None):
     """No-op for local detection."""
     return None
 
 
-def detect_damage(image_path):
+def detect_damage(image_path, img=None):
     """
     Analyze vehicle damage locally using OpenCV image processing and spatial heuristics.
     Maps image coordinates to logical vehicle parts and analyzes contour shapes.
+    Pass an already decoded BGR img to skip reading image_path from disk.
     """
     try:
         # Load image
-        img = cv2.imread(image_path)
+        if img is None:
+            img = cv2.imread(image_path)
         if img is None:
             raise FileNotFoundError(f"Could not read image at {image_path}")
 
         height, width = img.shape[:2]
 
+        # Cap the working size for callers that skipped preprocess_image
+        if max(height, width) > MAX_DIM:
+            scale = MAX_DIM / max(height, width)
+            width, height = int(width * scale), int(height * scale)
+            img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+        gray_buf, blur_buf, edge_buf, close_buf = _scratch_buffers((height, width))
+
         # Basic image processing for damage detection
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray_buf)
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0, dst=blur_buf)
         
         # Use adaptive thresholding and Canny to find structural variations
-        edges = cv2.Canny(blurred, 30, 100)
+        edges = cv2.Canny(blurred, 30, 100, edges=edge_buf)
         
-        # Dilate edges to bridge small gaps in damage regions
-        kernel = np.ones((3,3), np.uint8)
-        dilated = cv2.dilate(edges, kernel, iterations=1)
+        # Close edges (dilate + erode in one pass) to bridge small gaps in damage regions
+        closed = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, _CLOSE_KERNEL, dst=close_buf)
         
         # Find contours
-        contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1)
         
         # Filter significant areas (minimizing noise)
-        significant_contours = [cnt for cnt in contours if cv2.contourArea(cnt) > 800]
-        
-        damages = []
-        for cnt in significant_contours[:8]: # Analyze top 8 potential points
-            x, y, w, h = cv2.boundingRect(cnt)
-            area = cv2.contourArea(cnt)
-            aspect_ratio = float(w)/h if h > 0 else 0
-            
-            # 1. Precise Part Identification via Spatial Mapping (Heuristics)
-            # Normalizing coordinates (0.0 to 1.0)
-            nx = (x + w/2) / width
-            ny = (y + h/2) / height
-            
-            part = "body_panel"
-            if ny > 0.75:
-                part = "front_bumper" if nx < 0.5 else "rear_bumper"
-            elif ny < 0.35:
-                part = "hood" if nx < 0.7 else "roof"
-            elif nx < 0.2 or nx > 0.8:
-                part = "fender"
-            elif ny > 0.4 and ny < 0.7:
-                part = "door"
-            
-            # Specific check for headlights/taillights (corners)
-            if (nx < 0.15 or nx > 0.85) and (ny > 0.6 and ny < 0.8):
-                part = "headlight" if nx < 0.5 else "taillight"
-
-            # 2. Damage Type Classification via Shape Analysis
-            # Long, thin contours are likely scratches. Large, rounder ones are dents.
-            if aspect_ratio > 4 or aspect_ratio < 0.25:
-                damage_type = "scratch"
-            elif area > 10000:
-                damage_type = "dent"
-            elif area > 5000:
-                damage_type = "deformation"
-            else:
-                damage_type = "paint_damage"
-
-            # 3. Severity Calculation
-            severity = "minor"
-            if area > 15000 or (damage_type == "dent" and area > 8000):
-                severity = "moderate"
-            if area > 35000:
-                severity = "severe"
-
-            damages.append({
-                "part": part,
-                "damage_type": damage_type,
-                "severity": severity,
-                "confidence": round(0.75 + (min(area, 20000) / 200000), 2),
-                "description": f"Local analysis detected {damage_type} on the {part.replace('_', ' ')} (Size: {int(area)}px)."
-            })
+        areas = np.array([cv2.contourArea(cnt) for cnt in contours], dtype=np.float64)
+        significant = np.flatnonzero(areas > 800)
+        significant_contours = [contours[i] for i in significant]
+
+        damages = classify_regions(
+            np.array([cv2.boundingRect(cnt) for cnt in significant_contours[:8]], dtype=np.float64).reshape(-1, 4),
+            areas[significant[:8]],  # Analyze top 8 potential points
+            width,
+            height
+        )
 
         # Final Logic & Summary
         vehicle_detected = len(significant_contours) > 0
@@ -1,75 +1,200 @@
 """Image preprocessing utilities for damage analysis."""
 import os
 import cv2
+import mmap
 import base64
 import numpy as np
+from PIL import Image
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'bmp'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'webp', 'bmp'})
+JPEG_EXTENSIONS = frozenset({'jpg', 'jpeg'})
 MAX_DIM = 1024
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'uploads')
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024  # 16MB max upload
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # read/copy uploads in 1MB blocks
+BASE64_CHUNK_SIZE = 57 * 1024  # multiple of 3 bytes
+# Encoder settings for the resized write-back, keyed by extension; favour encode speed
+WRITE_PARAMS = {
+    'jpg': [cv2.IMWRITE_JPEG_QUALITY, 90, cv2.IMWRITE_JPEG_OPTIMIZE, 0],
+    'jpeg': [cv2.IMWRITE_JPEG_QUALITY, 90, cv2.IMWRITE_JPEG_OPTIMIZE, 0],
+    'png': [cv2.IMWRITE_PNG_COMPRESSION, 1],
+}
+PREVIEW_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+# Suffix tuple for str.endswith; covers the usual all-lower/all-upper spellings
+_ALLOWED_SUFFIXES = tuple(f'.{e}' for e in ALLOWED_EXTENSIONS) + tuple(f'.{e.upper()}' for e in ALLOWED_EXTENSIONS)
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads')
+
+
+def split_ext(filename):
+    """Return the lowercased extension of a filename, or '' if it has none."""
+    i = filename.rfind('.')
+    return filename[i + 1:].lower() if i != -1 else ''
 
 
 def allowed_file(filename):
     """Check if the file extension is allowed."""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    # Mixed-case extensions (e.g. '.Jpg') miss the suffix tuple and take the slower path
+    return filename.endswith(_ALLOWED_SUFFIXES) or split_ext(filename) in ALLOWED_EXTENSIONS
 
 
-def preprocess_image(image_path):
+def _exif_swaps_axes(header):
+    """True if the EXIF orientation of an open PIL image rotates it by 90/270 degrees."""
+    return header.getexif().get(0x0112) in (5, 6, 7, 8)
+
+
+def _jpeg_reduced_flag(max_side):
+    """imread flag decoding a JPEG at the largest DCT scale-down that stays at or above MAX_DIM."""
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if max_side // factor >= MAX_DIM:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def preprocess_image(image_path, with_metadata=False):
     """
     Preprocess image for damage detection using OpenCV.
     - Resizes to a max dimension of 1024px while maintaining aspect ratio
-    - Saves the preprocessed image back to disk
+    - Large JPEGs are decoded directly at a reduced scale by libjpeg
+    - Saves the resized image back to disk (untouched images are not re-encoded)
+    Returns the decoded (and possibly resized) image, or (image, metadata) when
+    with_metadata is set so callers can skip get_image_metadata.
     """
-    img = cv2.imread(image_path)
+    ext = split_ext(image_path)
+    is_jpeg = ext in JPEG_EXTENSIONS
+    flags = cv2.IMREAD_COLOR
+    if is_jpeg:
+        # Header-only read; lets libjpeg skip most of the decode work for big photos
+        try:
+            with Image.open(image_path) as header:
+                orig_w, orig_h = header.size
+                # cv2.imread applies EXIF rotation, so the decoded axes follow the tag
+                if _exif_swaps_axes(header):
+                    orig_w, orig_h = orig_h, orig_w
+            flags = _jpeg_reduced_flag(max(orig_w, orig_h))
+        except (OSError, SyntaxError):
+            pass
+
+    img = cv2.imread(image_path, flags)
     if img is None:
-        return None
+        return (None, {}) if with_metadata else None
 
     # Get original dimensions
     h, w = img.shape[:2]
+    if flags != cv2.IMREAD_COLOR:
+        # Size the output from the full-resolution header, not the rounded reduced decode
+        h, w = orig_h, orig_w
 
     # Calculate scale factor
     if max(h, w) > MAX_DIM:
         scale = MAX_DIM / max(h, w)
         new_w, new_h = int(w * scale), int(h * scale)
-        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
 
-    # Overwrite original image with preprocessed version
-    cv2.imwrite(image_path, img)
-    return img
+        # Overwrite original image with preprocessed version
+        _, buffer = cv2.imencode(f'.{ext}', img, WRITE_PARAMS.get(ext, []))
+        with open(image_path, 'wb') as f:
+            f.write(buffer)
+        file_size = buffer.size
+    else:
+        file_size = None
+
+    if not with_metadata:
+        return img
+    if file_size is None:
+        file_size = os.path.getsize(image_path)
+    return img, _image_metadata(image_path, img, file_size)
 
 
 def image_to_base64(image_path):
     """Convert image file to base64 string."""
+    # Encode straight from the page cache in 3-byte-aligned blocks so no padding lands mid-stream
+    out = bytearray()
     with open(image_path, 'rb') as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for start in range(0, len(view), BASE64_CHUNK_SIZE):
+                out += base64.b64encode(view[start:start + BASE64_CHUNK_SIZE])
+    return out.decode('ascii')
 
 
-def mat_to_base64(img_mat, format='.jpg'):
-    """Convert OpenCV Mat to base64 string."""
-    _, buffer = cv2.imencode(format, img_mat)
-    return base64.b64encode(buffer).decode('utf-8')
+def _decode_mapped(image_path):
+    """Decode an image file via mmap + cv2.imdecode, without copying it into a bytes object first."""
+    with open(image_path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buf = np.frombuffer(mm, dtype=np.uint8)
+            img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+            del buf  # release the export so the map can close
+    return img
 
 
-def get_image_metadata(image_path):
-    """Extract metadata from image using OpenCV."""
-    img = cv2.imread(image_path)
+def mat_to_base64(img_mat, format='.jpg'):
+    """
+    Convert OpenCV Mat to base64 string.
+    format='.ppm' skips the codec entirely (raw pixels behind a netpbm header) for
+    preview consumers that don't need a compressed image.
+    """
+    if format == '.ppm':
+        shape = img_mat.shape
+        h, w = shape[:2]
+        if len(shape) == 2:
+            buffer = b'P5\n%d %d\n255\n' % (w, h) + img_mat.tobytes()
+        else:
+            buffer = b'P6\n%d %d\n255\n' % (w, h) + cv2.cvtColor(img_mat, cv2.COLOR_BGR2RGB).tobytes()
+        return base64.b64encode(buffer).decode('ascii')
+    _, buffer = cv2.imencode(format, img_mat, PREVIEW_JPEG_PARAMS if format in ('.jpg', '.jpeg') else [])
+    return base64.b64encode(buffer).decode('ascii')
+
+
+def get_image_metadata(image_path, img=None):
+    """
+    Extract metadata from an image. Pass an already decoded img to skip reading it;
+    otherwise only the file header is parsed, falling back to a full decode.
+    """
     if img is None:
-        return {}
-
-    h, w = img.shape[:2]
-    file_size = os.path.getsize(image_path)
+        try:
+            with Image.open(image_path) as header:
+                w, h = header.size
+                # cv2.imread honours EXIF orientation, so report the axes the same way
+                if _exif_swaps_axes(header):
+                    w, h = h, w
+            # Matches cv2.imread's default of decoding to 3-channel BGR
+            return _metadata(image_path, w, h, 3, os.path.getsize(image_path))
+        except (OSError, SyntaxError):
+            img = _decode_mapped(image_path)
+        if img is None:
+            return {}
+
+    return _image_metadata(image_path, img, os.path.getsize(image_path))
+
+
+def _image_metadata(image_path, img, file_size):
+    """Metadata dict for a decoded image and the size of its file on disk."""
+    shape = img.shape
+    return _metadata(image_path, shape[1], shape[0], shape[2] if len(shape) > 2 else 1, file_size)
+
+
+def _metadata(image_path, width, height, channels, file_size):
+    """Metadata dict from image dimensions and the size of its file on disk."""
     ext = image_path.rsplit('.', 1)[-1].lower()
 
     return {
-        'width': w,
-        'height': h,
+        'width': width,
+        'height': height,
         'format': ext.upper(),
-        'channels': img.shape[2] if len(img.shape) > 2 else 1,
+        'channels': channels,
         'file_size_kb': round(file_size / 1024, 2)
     }
 
 
+_upload_dir_ready = False
+
+
 def ensure_upload_dir():
-    """Ensure upload directory exists."""
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    """Ensure upload directory exists (created once per process)."""
+    global _upload_dir_ready
+    if not _upload_dir_ready:
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        _upload_dir_ready = True
     return UPLOAD_FOLDER
@@ -1,6 +1,10 @@
 """Report generation module for damage assessment results."""
 from datetime import datetime
-import json
+import orjson
+
+REPORT_ID_FORMAT = 'VCR-%Y%m%d%H%M%S'
+DISCLAIMER = ('This is an AI-generated pre-approval estimate. Final costs may vary based on in-person inspection. '
+              'This estimate is valid for 30 days from the date of generation.')
 
 
 def generate_report(detection_result, severity_assessment, cost_estimate, image_filename=None):
@@ -8,9 +12,10 @@ def generate_report(detection_result, severity_assessment, cost_estimate, image_
     Generate a comprehensive damage assessment report.
     Combines detection, severity, and cost data into a final report.
     """
+    now = datetime.now()
     report = {
-        'report_id': f"VCR-{datetime.now().strftime('%Y%m%d%H%M%S')}",
-        'generated_at': datetime.now().isoformat(),
+        'report_id': now.strftime(REPORT_ID_FORMAT),
+        'generated_at': now.isoformat(),
         'image_file': image_filename,
 
         'vehicle_info': {
@@ -34,44 +39,43 @@ def generate_report(detection_result, severity_assessment, cost_estimate, image_
         'recommendation': cost_estimate['recommendation'],
         'estimated_repair_days': cost_estimate['estimated_repair_days'],
 
-        'disclaimer': 'This is an AI-generated pre-approval estimate. Final costs may vary based on in-person inspection. This estimate is valid for 30 days from the date of generation.'
+        'disclaimer': DISCLAIMER
     }
 
     # Enrich each damage entry with its corresponding cost information (if available)
     try:
-        line_items_by_part = {}
+        damages_by_part = {}
+        for dmg in report['damage_assessment'].get('damages', []):
+            part_key = dmg.get('part')
+            if part_key:
+                damages_by_part.setdefault(part_key, []).append(dmg)
+
+        # If multiple line items map to the same part, aggregate subtotals
+        totals = {}
         for item in cost_estimate.get('line_items', []):
             key = item.get('part_key')
-            if not key:
+            if key not in damages_by_part:
                 continue
-            # If multiple damages map to same part, aggregate subtotals
-            existing = line_items_by_part.get(key)
-            if existing:
-                existing['part_cost'] += item.get('part_cost', 0)
-                existing['labor_cost'] += item.get('labor_cost', 0)
-                existing['paint_cost'] += item.get('paint_cost', 0)
-                existing['subtotal'] += item.get('subtotal', 0)
+            costs = totals.get(key)
+            if costs is None:
+                totals[key] = [item.get('part_cost', 0), item.get('labor_cost', 0),
+                               item.get('paint_cost', 0), item.get('subtotal', 0)]
             else:
-                line_items_by_part[key] = {
-                    'part_cost': item.get('part_cost', 0),
-                    'labor_cost': item.get('labor_cost', 0),
-                    'paint_cost': item.get('paint_cost', 0),
-                    'subtotal': item.get('subtotal', 0),
-                }
+                costs[0] += item.get('part_cost', 0)
+                costs[1] += item.get('labor_cost', 0)
+                costs[2] += item.get('paint_cost', 0)
+                costs[3] += item.get('subtotal', 0)
 
-        damages = report['damage_assessment'].get('damages', [])
-        for dmg in damages:
-            part_key = dmg.get('part')
-            if not part_key:
-                continue
-            costs = line_items_by_part.get(part_key)
-            if not costs:
-                continue
-            # Attach aggregated costs to the damage entry
-            dmg['part_cost'] = round(costs['part_cost'], 2)
-            dmg['labor_cost'] = round(costs['labor_cost'], 2)
-            dmg['paint_cost'] = round(costs['paint_cost'], 2)
-            dmg['total_cost'] = round(costs['subtotal'], 2)
+        # Round once per part and attach to every damage entry on that part
+        for key, (part_cost, labor_cost, paint_cost, subtotal) in totals.items():
+            rounded = {
+                'part_cost': round(part_cost, 2),
+                'labor_cost': round(labor_cost, 2),
+                'paint_cost': round(paint_cost, 2),
+                'total_cost': round(subtotal, 2),
+            }
+            for dmg in damages_by_part[key]:
+                dmg.update(rounded)
     except Exception:
         # Cost enrichment is best-effort; never break report generation
         pass
@@ -81,4 +85,4 @@ def generate_report(detection_result, severity_assessment, cost_estimate, image_
 
 def report_to_json(report):
     """Convert report to JSON string."""
-    return json.dumps(report, indent=2, default=str)
+    return orjson.dumps(report, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY).decode()
@@ -1,4 +1,5 @@
 """Severity assessment module for damage classification."""
+from bisect import bisect_left
 
 
 SEVERITY_LEVELS = {
@@ -25,11 +26,20 @@ SEVERITY_LEVELS = {
     }
 }
 
+_SEVERITY_SCORES = {'minor': 1, 'moderate': 2, 'severe': 3}
+# severity -> (score, info); unknown severities score and display as minor
+_SEVERITY_TABLE = {k: (_SEVERITY_SCORES[k], v) for k, v in SEVERITY_LEVELS.items()}
+_DEFAULT_SEVERITY = _SEVERITY_TABLE['minor']
+# Upper bounds (inclusive) of the average score for each overall level
+_SCORE_BUCKETS = (1.3, 2.3)
+_BUCKET_LEVELS = ('minor', 'moderate', 'severe')
 
-def assess_severity(damages):
+
+def assess_severity(damages, include_breakdown=True):
     """
     Assess overall severity based on individual damage items.
-    Returns severity level and detailed breakdown.
+    Returns severity level and detailed breakdown; pass include_breakdown=False
+    when only the aggregate is needed and 'breakdown' is left empty.
     """
     if not damages:
         return {
@@ -41,16 +51,18 @@ def assess_severity(damages):
             'breakdown': []
         }
 
-    severity_scores = {'minor': 1, 'moderate': 2, 'severe': 3}
     total_score = 0
+    has_severe = False
     breakdown = []
 
     for damage in damages:
         severity = damage.get('severity', 'minor')
-        score = severity_scores.get(severity, 1)
+        score, severity_info = _SEVERITY_TABLE.get(severity, _DEFAULT_SEVERITY)
         total_score += score
+        has_severe |= severity == 'severe'
+        if not include_breakdown:
+            continue
 
-        severity_info = SEVERITY_LEVELS.get(severity, SEVERITY_LEVELS['minor'])
         breakdown.append({
             'part': damage.get('part', 'unknown'),
             'damage_type': damage.get('damage_type', 'unknown'),
@@ -65,17 +77,11 @@ def assess_severity(damages):
     # Calculate average severity
     avg_score = total_score / len(damages)
 
-    if avg_score <= 1.3:
-        overall = 'minor'
-    elif avg_score <= 2.3:
-        overall = 'moderate'
-    else:
-        overall = 'severe'
+    overall = _BUCKET_LEVELS[bisect_left(_SCORE_BUCKETS, avg_score)]
 
     # Upgrade if any single damage is severe
-    if any(d.get('severity') == 'severe' for d in damages):
-        if overall == 'minor':
-            overall = 'moderate'
+    if has_severe and overall == 'minor':
+        overall = 'moderate'
 
     severity_info = SEVERITY_LEVELS[overall]
 